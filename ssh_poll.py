@@ -1,8 +1,468 @@
 import paramiko
+import asyncio
+import collections
+import functools
+import hashlib
+import hmac
 import logging
+import os
+import re
+import select
+import selectors
 import socket
+import threading
 import time
-import datetime
+ 
+try:
+    import asyncssh  # only needed by AsyncMySSH
+except ImportError:
+    asyncssh = None
+ 
+try:
+    import ssh2.error_codes  # only needed by the libssh2 backend
+    import ssh2.exceptions
+    import ssh2.session
+except ImportError:
+    ssh2 = None
+ 
+ 
+# The logger is set up once here, setting it up per instance would add
+# a handler (and duplicate every message) for each MySSH object.
+_logger = logging.getLogger('MySSH')
+if not _logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter(
+        '%(asctime)s MySSH:%(funcName)s:%(lineno)d %(message)s'))
+    _logger.addHandler(_handler)
+ 
+ 
+# Escaped new lines (\n typed as two characters) in the input data.
+_INPUT_ESCAPES = re.compile(r'\\n')
+ 
+# A password prompt (e.g. '[sudo] password for user: ') at the end of
+# the output.
+_PROMPT_RE = re.compile(rb'[Pp]assword[^\r\n]*:\s*$')
+_PROMPT_TAIL = 128
+ 
+ 
+# Ciphers that run in hardware on CPUs with AES-NI (through the
+# cryptography backend). Pass them to MySSH.connect() to keep the
+# slower CBC ciphers out of the negotiation.
+FAST_CIPHERS = ('aes128-gcm@openssh.com',
+                'aes256-gcm@openssh.com',
+                'aes128-ctr',
+                'aes256-ctr')
+ 
+ 
+# ================================================================
+# class SSHPool
+# ================================================================
+class SSHPool:
+    '''
+    Keep idle SSH clients so that later connections to the same host
+    reuse them instead of paying for the TCP handshake, the key
+    exchange and the authentication again.
+    Clients are only handed out for the same credentials and options
+    they were opened with.
+    Here is a typical usage:
+ 
+        key = SSHPool.make_key('host', 'user', 'password', 22, 'paramiko')
+        client = SSHPool.acquire(key)
+        if client is None:
+            client = paramiko.SSHClient()
+            client.connect('host', username='user', password='password')
+        ...
+        SSHPool.release(key, client)
+ 
+    Idle clients are closed once they have been idle for max_idle
+    seconds, checked on every release() across all keys. Call
+    SSHPool.close_all() to close the remaining ones, e.g. at the end of
+    a fan-out over many hosts.
+    '''
+    max_idle = 300  # seconds an idle client is kept
+    _pools = {}
+    _lock = threading.Lock()
+    _secret = os.urandom(32)  # keys the password hashes in pool keys
+ 
+    @classmethod
+    def make_key(cls, hostname, username, password, port, backend,
+                 ciphers=None, kex=None, compress=False):
+        '''
+        Build the pool key of a connection.
+        The password is only kept as a keyed hash.
+ 
+        @param hostname  The hostname.
+        @param username  The username.
+        @param password  The password.
+        @param port      The port.
+        @param backend   The MySSH backend.
+        @param ciphers   The allowed ciphers (default=None).
+        @param kex       The allowed key exchange algorithms (default=None).
+        @param compress  Enable/disable compression (default=False).
+        @returns the key.
+        '''
+        credential = hmac.new(cls._secret,
+                              (password or '').encode('utf-8'),
+                              hashlib.sha256).digest()
+        return (hostname, username, port, backend, credential,
+                None if ciphers is None else tuple(ciphers),
+                None if kex is None else tuple(kex),
+                bool(compress))
+ 
+    @classmethod
+    def acquire(cls, key):
+        '''
+        Take a live client out of the pool.
+ 
+        @param key  The key from make_key().
+        @returns a connected client or None if there is none.
+        '''
+        now = time.monotonic()
+        while True:
+            with cls._lock:
+                pool = cls._pools.get(key)
+                if not pool:
+                    return None
+                client, released = pool.pop()
+                if not pool:
+                    del cls._pools[key]
+            transport = client.get_transport()
+            if (now - released <= cls.max_idle and
+                    transport is not None and transport.is_active()):
+                return client
+            client.close()
+ 
+    @classmethod
+    def release(cls, key, client):
+        '''
+        Give a client back to the pool.
+        Clients of any key that have been idle for too long are closed,
+        otherwise the ones of hosts that are never connected to again
+        would stay open (and kept alive) for the life of the process.
+ 
+        @param key     The key from make_key().
+        @param client  The client returned by acquire() or newly connected.
+        '''
+        now = time.monotonic()
+        stale = []
+        with cls._lock:
+            for idle_key, pool in list(cls._pools.items()):
+                while pool and now - pool[0][1] > cls.max_idle:
+                    stale.append(pool.popleft()[0])
+                if not pool:
+                    del cls._pools[idle_key]
+            cls._pools.setdefault(key, collections.deque()).append(
+                (client, now))
+        for client in stale:
+            client.close()
+ 
+    @classmethod
+    def close_all(cls):
+        '''
+        Close all the pooled clients.
+        '''
+        with cls._lock:
+            pools = list(cls._pools.values())
+            cls._pools.clear()
+        for pool in pools:
+            for client, _ in pool:
+                client.close()
+ 
+ 
+# ================================================================
+# class Command
+# ================================================================
+class Command:
+    '''
+    A command running on its own channel of an SSH transport.
+    Iterate over it to read the output as it arrives, then ask for
+    the exit status:
+ 
+        cmd = ssh.run('uname -a')
+        for data in cmd:
+            sys.stdout.write(data.decode())
+        print 'status = %d' % (cmd.exit_status())
+ 
+    The output is not buffered locally, so keep consuming it: once
+    the channel window fills up the remote command blocks on its
+    writes. Use output() when the whole output is wanted at once.
+    '''
+    def __init__(self, session, output):
+        '''
+        @param session  The session (channel) the command runs on.
+        @param output   The generator that polls the session.
+        '''
+        self.session = session
+        self._output = output
+ 
+    def __iter__(self):
+        return self
+ 
+    def __next__(self):
+        return next(self._output)
+ 
+    def output(self):
+        '''
+        Read the rest of the output.
+ 
+        @returns the output decoded as UTF-8.
+        '''
+        buf = bytearray()
+        for data in self._output:
+            buf.extend(data)
+        return buf.decode('utf-8', 'replace')
+ 
+    def exit_status(self):
+        '''
+        Wait for the command to complete, output that was not read
+        yet is discarded. Draining it keeps the remote command from
+        blocking on a full channel window and applies the timeout.
+ 
+        @returns the exit status of the command.
+        @raises TimeoutError if the command does not complete in time.
+        '''
+        for _ in self._output:
+            pass
+        return self.session.recv_exit_status()
+ 
+ 
+# ================================================================
+# class Libssh2Client
+# ================================================================
+class Libssh2Client:
+    '''
+    The part of paramiko.SSHClient that MySSH uses, implemented on
+    top of libssh2 (ssh2-python) for MySSH(backend='libssh2').
+    Encryption, MACs and packet framing run in C instead of Python,
+    which pays off for bulk output like 'cat bigfile'.
+ 
+    Once connected the libssh2 session stays in non-blocking mode so
+    that its channels can be polled; calls that would block wait on
+    the socket and are retried.
+    '''
+    def __init__(self):
+        if ssh2 is None:
+            raise ImportError('the libssh2 backend requires ssh2-python')
+        self.transport = None
+ 
+    def connect(self, hostname, port, username, password,
+                compress=False, ciphers=None, kex=None):
+        '''
+        Connect to the host and authenticate.
+ 
+        @param hostname  The hostname.
+        @param port      The port.
+        @param username  The username.
+        @param password  The password.
+        @param compress  Enable/disable compression.
+        @param ciphers   The ciphers to allow (default=None, all).
+        @param kex       The key exchange algorithms to allow
+                         (default=None, all).
+        @raises paramiko.AuthenticationException if authentication fails.
+        @raises paramiko.SSHException on other SSH errors.
+        '''
+        sock = socket.create_connection((hostname, port))
+        session = ssh2.session.Session()
+        session.flag(ssh2.session.LIBSSH2_FLAG_COMPRESS, compress)
+        try:
+            if ciphers is not None:
+                prefs = ','.join(ciphers)
+                session.method_pref(ssh2.session.LIBSSH2_METHOD_CRYPT_CS, prefs)
+                session.method_pref(ssh2.session.LIBSSH2_METHOD_CRYPT_SC, prefs)
+            if kex is not None:
+                session.method_pref(ssh2.session.LIBSSH2_METHOD_KEX,
+                                    ','.join(kex))
+            session.handshake(sock)
+            session.userauth_password(username, password)
+        except ssh2.exceptions.AuthenticationError as e:
+            sock.close()
+            raise paramiko.AuthenticationException(str(e))
+        except ssh2.exceptions.SSH2Error as e:
+            sock.close()
+            raise paramiko.SSHException(str(e))
+        session.set_blocking(False)
+        self.transport = _Libssh2Transport(sock, session)
+ 
+    def get_transport(self):
+        return self.transport
+ 
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+ 
+ 
+class _Libssh2Transport:
+    '''
+    The part of paramiko.Transport that MySSH uses.
+    '''
+    def __init__(self, sock, session):
+        self.sock = sock
+        self.session = session
+        self.active = True
+        # libssh2 sessions are not thread safe, channels are used from
+        # several threads when commands run concurrently.
+        self.lock = threading.RLock()
+ 
+    def call(self, func, *args):
+        '''
+        Call a libssh2 function until it no longer returns EAGAIN.
+ 
+        @param func  The function.
+        @param args  The function arguments.
+        @returns the result of the function.
+        '''
+        while True:
+            with self.lock:
+                rc = func(*args)
+            if rc != ssh2.error_codes.LIBSSH2_ERROR_EAGAIN:
+                return rc
+            self.wait()
+ 
+    def wait(self, timeout=1.0):
+        '''
+        Wait until the socket is ready in the direction libssh2 is
+        blocked on.
+ 
+        @param timeout  The maximum wait in seconds.
+        '''
+        with self.lock:
+            directions = self.session.block_directions()
+        rlist = []
+        wlist = []
+        if directions & ssh2.session.LIBSSH2_SESSION_BLOCK_INBOUND:
+            rlist.append(self.sock)
+        if directions & ssh2.session.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            wlist.append(self.sock)
+        if not rlist and not wlist:
+            # Another thread already drained the socket: wait a little
+            # for more data instead of retrying right away.
+            rlist.append(self.sock)
+            timeout = min(timeout, 0.01)
+        select.select(rlist, wlist, [], timeout)
+ 
+    def is_active(self):
+        '''
+        Check that the connection is still up: a socket closed by the
+        peer is readable with nothing left to peek at.
+ 
+        @returns True if the connection is up or false otherwise.
+        '''
+        if not self.active:
+            return False
+        try:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error == 0:
+                if not select.select([self.sock], [], [], 0)[0]:
+                    return True
+                if self.sock.recv(1, socket.MSG_PEEK):
+                    return True
+        except OSError:
+            pass
+        self.active = False
+        return False
+ 
+    def set_keepalive(self, interval):
+        '''
+        libssh2 only sends keepalives from keepalive_send(), which
+        nothing calls while a pooled connection is idle, so TCP
+        keepalives are enabled on the socket as well.
+ 
+        @param interval  The keepalive interval in seconds, 0 disables it.
+        '''
+        with self.lock:
+            self.session.keepalive_config(False, interval)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE,
+                             1 if interval > 0 else 0)
+ 
+    def open_session(self):
+        return _Libssh2Channel(self, self.call(self.session.open_session))
+ 
+    def close(self):
+        if self.active:
+            self.active = False
+            with self.lock:
+                try:
+                    self.session.disconnect()
+                except ssh2.exceptions.SSH2Error:
+                    pass
+            self.sock.close()
+ 
+ 
+class _Libssh2Channel:
+    '''
+    The part of paramiko.Channel that MySSH uses.
+    '''
+    bufsize = 65536  # libssh2 packs reads of 32K or more best
+ 
+    def __init__(self, transport, channel):
+        self.transport = transport
+        self.channel = channel
+        self.closed = False
+        self.combine_stderr = False
+        self._data = b''
+ 
+    def fileno(self):
+        # All channels share the session socket, each _run_poll call
+        # registers it with its own selector.
+        return self.transport.sock.fileno()
+ 
+    def setblocking(self, blocking):
+        # The session is always non-blocking, see Libssh2Client.
+        pass
+ 
+    def set_combine_stderr(self, combine):
+        self.combine_stderr = combine
+ 
+    def get_pty(self):
+        self.transport.call(self.channel.pty)
+ 
+    def exec_command(self, cmd):
+        self.transport.call(self.channel.execute, cmd)
+ 
+    def sendall(self, data):
+        while data:
+            with self.transport.lock:
+                rc, written = self.channel.write(data)
+            data = data[written:]
+            if rc == ssh2.error_codes.LIBSSH2_ERROR_EAGAIN:
+                self.transport.wait()
+ 
+    def shutdown_write(self):
+        self.transport.call(self.channel.send_eof)
+ 
+    def recv_ready(self):
+        if not self._data:
+            with self.transport.lock:
+                size, data = self.channel.read(self.bufsize)
+                if size <= 0 and self.combine_stderr:
+                    size, data = self.channel.read_stderr(self.bufsize)
+            if size > 0:
+                self._data = data
+            elif size != ssh2.error_codes.LIBSSH2_ERROR_EAGAIN and size < 0:
+                raise paramiko.SSHException('libssh2 read error %d' % (size))
+        return len(self._data) > 0
+ 
+    def recv(self, nbytes):
+        self.recv_ready()
+        data = self._data[:nbytes]
+        self._data = self._data[nbytes:]
+        return data
+ 
+    def exit_status_ready(self):
+        with self.transport.lock:
+            return self.channel.eof()
+ 
+    def recv_exit_status(self):
+        self.transport.call(self.channel.wait_eof)
+        self.transport.call(self.channel.close)
+        self.transport.call(self.channel.wait_closed)
+        return self.channel.get_exit_status()
+ 
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.transport.call(self.channel.close)
  
  
 # ================================================================
@@ -19,136 +479,206 @@ class MySSH:
             sys.exit('Connection failed')
  
         # Run a command that does not require input.
-        status, output = ssh.run('uname -a')
-        print 'status = %d' % (status)
-        print 'output (%d):' % (len(output))
-        print '%s' % (output)
+        cmd = ssh.run('uname -a')
+        for data in cmd:
+            sys.stdout.write(data.decode())
+        print 'status = %d' % (cmd.exit_status())
  
         # Run a command that does requires input.
-        status, output = ssh.run('sudo uname -a', 'sudo-password')
-        print 'status = %d' % (status)
-        print 'output (%d):' % (len(output))
-        print '%s' % (output)
+        cmd = ssh.run('sudo uname -a', 'sudo-password')
+        for data in cmd:
+            sys.stdout.write(data.decode())
+        print 'status = %d' % (cmd.exit_status())
+ 
+    The SSH protocol is handled by paramiko unless the libssh2 backend
+    (ssh2-python) is selected with MySSH(backend='libssh2').
     '''
-    def __init__(self, compress=True, verbose=False):
+    def __init__(self, compress=False, verbose=False, backend='paramiko',
+                 keepalive=30):
         '''
         Setup the initial verbosity level and the logger.
  
-        @param compress  Enable/disable compression.
-        @param verbose   Enable/disable verbose messages.
+        @param compress   Enable/disable compression (default=False).
+                          Compression only pays off for compressible
+                          output like plain text on slow links.
+        @param verbose    Enable/disable verbose messages.
+        @param backend    'paramiko' (default) or 'libssh2'.
+        @param keepalive  The keepalive interval in seconds that keeps
+                          idle pooled connections from being dropped by
+                          NAT or firewalls, 0 disables it (default=30).
         '''
+        if backend not in ('paramiko', 'libssh2'):
+            raise ValueError('unknown backend: %s' % (backend))
         self.ssh = None
         self.transport = None
+        self.hostname = None
+        self.username = None
+        self.port = None
+        self._key = None
         self.compress = compress
+        self.backend = backend
+        self.keepalive = keepalive
         self.bufsize = 65536
  
         # Setup the logger
-        self.logger = logging.getLogger('MySSH')
+        self.logger = _logger
         self.set_verbosity(verbose)
- 
-        fmt = '%(asctime)s MySSH:%(funcName)s:%(lineno)d %(message)s'
-        format = logging.Formatter(fmt)
-        handler = logging.StreamHandler()
-        handler.setFormatter(format)
-        self.logger.addHandler(handler)
         self.info = self.logger.info
  
     def __del__(self):
         if self.transport is not None:
-            self.transport.close()
+            SSHPool.release(self._key, self.ssh)
             self.transport = None
  
-    def connect(self, hostname, username, password, port=22):
+    def connect(self, hostname, username, password, port=22,
+                ciphers=None, kex=None, compress=None):
         '''
         Connect to the host.
+        A pooled connection is reused when there is one that was opened
+        with the same credentials and options.
  
         @param hostname  The hostname.
         @param username  The username.
         @param password  The password.
         @param port      The port (default=22).
+        @param ciphers   The ciphers to allow, e.g. FAST_CIPHERS
+                         (default=None, all ciphers of the backend).
+        @param kex       The key exchange algorithms to allow
+                         (default=None, all algorithms of the backend).
+        @param compress  Enable/disable compression (default=None, the
+                         setting given to the constructor).
  
         @returns True if the connection succeeded or false otherwise.
         '''
-        self.info('connecting %s@%s:%d' % (username, hostname, port))
+        self.info('connecting %s@%s:%d', username, hostname, port)
         self.hostname = hostname
         self.username = username
         self.port = port
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if compress is None:
+            compress = self.compress
+        self._key = SSHPool.make_key(hostname, username, password, port,
+                                     self.backend, ciphers, kex, compress)
+        self.ssh = SSHPool.acquire(self._key)
+        if self.ssh is not None:
+            self.transport = self.ssh.get_transport()
+            self.info('reusing: %s@%s:%d', username, hostname, port)
+            return True
+ 
+        if self.backend == 'libssh2':
+            self.ssh = Libssh2Client()
+            options = {'ciphers': ciphers, 'kex': kex}
+        else:
+            disabled = {}
+            if ciphers is not None:
+                disabled['ciphers'] = [c for c in paramiko.Transport._preferred_ciphers
+                                       if c not in ciphers]
+            if kex is not None:
+                disabled['kex'] = [k for k in paramiko.Transport._preferred_kex
+                                   if k not in kex]
+            self.ssh = paramiko.SSHClient()
+            self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            options = {'disabled_algorithms': disabled}
+ 
         try:
             self.ssh.connect(hostname=hostname,
                              port=port,
                              username=username,
-                             password=password)
+                             password=password,
+                             compress=compress,
+                             **options)
             self.transport = self.ssh.get_transport()
-            self.transport.use_compression(self.compress)
-            self.info('succeeded: %s@%s:%d' % (username,
-                                               hostname,
-                                               port))
+ 
+            # Disable Nagle so that small writes like input data or
+            # channel requests are not held back waiting for an ACK.
+            self.transport.sock.setsockopt(socket.IPPROTO_TCP,
+                                           socket.TCP_NODELAY, 1)
+            self.transport.set_keepalive(self.keepalive)
+            self.info('succeeded: %s@%s:%d', username, hostname, port)
         except socket.error as e:
             self.transport = None
-            self.info('failed: %s@%s:%d: %s' % (username,
-                                                hostname,
-                                                port,
-                                                str(e)))
+            self.info('failed: %s@%s:%d: %s', username, hostname, port, e)
         except paramiko.BadAuthenticationType as e:
             self.transport = None
-            self.info('failed: %s@%s:%d: %s' % (username,
-                                                hostname,
-                                                port,
-                                                str(e)))
+            self.info('failed: %s@%s:%d: %s', username, hostname, port, e)
  
         return self.transport is not None
  
-    def run(self, cmd, input_data=None, timeout=10):
+    def run(self, cmd, input_data=None, timeout=10,
+            min_interval=0.001, max_interval=0.05, pty=None):
         '''
         Run a command with optional input data.
+        Each command gets its own channel on the shared transport so
+        several commands can run at the same time, e.g. from threads.
+        A pseudo terminal is only allocated when it is asked for or
+        when there is input data (e.g. a sudo password), because it
+        translates new lines and slows down bulk output. With a pseudo
+        terminal the input data is only sent once the command prompts
+        for a password so that it is never echoed into the output;
+        use pty=False to write it to stdin right away instead.
  
         Here is an example that shows how to run commands with no input:
  
             ssh = MySSH()
             ssh.connect('host', 'user', 'password')
-            status, output = ssh.run('uname -a')
-            status, output = ssh.run('uptime')
+            cmd = ssh.run('uname -a')
+            cmd = ssh.run('uptime')
  
         Here is an example that shows how to run commands that require input:
  
             ssh = MySSH()
             ssh.connect('host', 'user', 'password')
-            status, output = ssh.run('sudo uname -a', '<sudo-password>')
+            cmd = ssh.run('sudo uname -a', '<sudo-password>')
+            cmd = ssh.run('top -b -n 1', pty=True)
+            cmd = ssh.run('sort', 'b\\na', pty=False)
  
-        @param cmd         The command to run.
-        @param input_data  The input data (default is None).
-        @param timeout     The timeout in seconds (default is 10 seconds).
-        @returns The status and the output (stdout and stderr combined).
+        Here is an example that runs commands concurrently:
+ 
+            def drain(cmd):
+                for data in cmd:
+                    pass
+                return cmd.exit_status()
+ 
+            cmds = [ssh.run('uptime'), ssh.run('df -h')]
+            with ThreadPoolExecutor() as pool:
+                statuses = list(pool.map(drain, cmds))
+ 
+        @param cmd           The command to run.
+        @param input_data    The input data (default is None).
+        @param timeout       The timeout in seconds (default is 10 seconds).
+        @param min_interval  The shortest poll interval in seconds
+                             (default is 1 ms).
+        @param max_interval  The longest poll interval in seconds
+                             (default is 50 ms).
+        @param pty           Allocate a pseudo terminal (default is None,
+                             only when there is input data).
+        @returns The Command that streams the output (stdout and stderr
+                 combined) and reports the exit status. Iterating it
+                 raises TimeoutError if the command does not complete
+                 in time.
+        @raises ConnectionError if there is no connection.
         '''
-        self.info('running command: (%d) %s' % (timeout, cmd))
+        self.info('running command: (%d) %s', timeout, cmd)
  
         if self.transport is None:
-            self.info('no connection to %s@%s:%s' % (str(self.username),
-                                                     str(self.hostname),
-                                                     str(self.port)))
-            return -1, 'ERROR: connection not established\n'
+            self.info('no connection to %s@%s:%s',
+                      self.username, self.hostname, self.port)
+            raise ConnectionError('connection not established')
  
         # Fix the input data.
         input_data = self._run_fix_input_data(input_data)
  
         # Initialize the session.
         self.info('initializing the session')
-        self.session = self.transport.open_session()
-        self.session.set_combine_stderr(True)
-        self.session.get_pty()
-        self.session.exec_command(cmd)
-        output = self._run_poll(self.session, timeout, input_data)
-        return output
-        #status = self.session.recv_exit_status()
-        #self.info('output size %d' % (len(output)))
-        #self.info('status %d' % (status))
-        #return status, output
-
-    def get_exit_status(self):
-        return self.session.recv_exit_status()
-
+        session = self.transport.open_session()
+        session.set_combine_stderr(True)
+        if pty is None:
+            pty = len(input_data) > 0
+        if pty:
+            session.get_pty()
+        session.exec_command(cmd)
+        output = self._run_poll(session, timeout, input_data,
+                                min_interval, max_interval, pty)
+        return Command(session, output)
  
     def connected(self):
         '''
@@ -169,65 +699,360 @@ class MySSH:
         else:
             self.logger.setLevel(logging.ERROR)
  
-    def _run_fix_input_data(self, input_data):
+    @staticmethod
+    def _run_fix_input_data(input_data):
         '''
         Fix the input data supplied by the user for a command.
  
         @param input_data  The input data (default is None).
-        @returns the fixed input data.
+        @returns the fixed input data as bytes ending with a new line
+                 or empty bytes if there is no input data.
         '''
-        if input_data is not None:
-            if len(input_data) > 0:
-                if '\\n' in input_data:
-                    # Convert \n in the input into new lines.
-                    lines = input_data.split('\\n')
-                    input_data = '\n'.join(lines)
-            return input_data.split('\n')
-        return []
+        if input_data:
+            # Convert \n in the input into new lines.
+            input_data = _INPUT_ESCAPES.sub('\n', input_data)
+            if not input_data.endswith('\n'):
+                input_data += '\n'
+            return input_data.encode('utf-8')
+        return b''
  
-    def _run_send_input(self, session, stdin, input_data):
+    def _run_send_input(self, session, input_data):
         '''
         Send the input data.
+        It is written with a single sendall() so that it is packed into
+        as few SSH packets as possible.
  
         @param session     The session.
-        @param stdin       The stdin stream for the session.
-        @param input_data  The input data (default is None).
+        @param input_data  The input data from _run_fix_input_data().
         '''
-        if input_data is not None:
-            self.info('session.exit_status_ready() %s' % str(session.exit_status_ready()))
-            self.info('stdin.channel.closed %s' % str(stdin.channel.closed))
-            if stdin.channel.closed is False:
+        if input_data:
+            if self.logger.isEnabledFor(logging.INFO):
+                self.info('session.exit_status_ready() %s',
+                          session.exit_status_ready())
+                self.info('session.closed %s', session.closed)
+            if session.closed is False:
                 self.info('sending input data')
-                stdin.write(input_data)
+                session.sendall(input_data)
  
-    def _run_poll(self, session, timeout, input_data):
+    def _run_poll(self, session, timeout, input_data,
+                  min_interval, max_interval, pty=False):
         '''
         Poll until the command completes.
+        The poll interval starts at min_interval, grows towards
+        max_interval while there is no output and drops back to
+        min_interval whenever data is read.
  
-        @param session     The session.
-        @param timeout     The timeout in seconds.
-        @param input_data  The input data.
-        @returns the output
+        Without a pseudo terminal the input data is written to stdin
+        up front and stdin is closed. With one, the next line of the
+        input data is sent each time the output ends with a password
+        prompt: sent earlier, it would be echoed into the output and the
+        prompt would discard it anyway (e.g. sudo).
+ 
+        @param session       The session.
+        @param timeout       The timeout in seconds.
+        @param input_data    The input data.
+        @param min_interval  The shortest poll interval in seconds.
+        @param max_interval  The longest poll interval in seconds.
+        @param pty           True if the session has a pseudo terminal.
+        @returns a generator of output chunks (bytes).
+        @raises TimeoutError if the command does not complete in time.
         '''
-        interval = 0.1
+        interval = min_interval
         maxseconds = timeout
-        maxcount = maxseconds / interval
  
         # Poll until completion or timeout
         # Note that we cannot directly use the stdout file descriptor
         # because it stalls at 64K bytes (65536).
-        input_idx = 0
         timeout_flag = False
-        self.info('polling (%d, %d)' % (maxseconds, maxcount))
-        start = datetime.datetime.now()
-        start_secs = time.mktime(start.timetuple())
-        output = ''
+        tail = b''
+        prompts = collections.deque(input_data.splitlines(True) if pty else ())
+        self.info('polling (%d, %.3f, %.3f)',
+                  maxseconds, min_interval, max_interval)
+        deadline = time.monotonic() + maxseconds
+        if not pty:
+            # Nothing else is ever written, close stdin so that commands
+            # that read it to the end (e.g. sort) complete.
+            self._run_send_input(session, input_data)
+            session.shutdown_write()
         session.setblocking(0)
-        while True:
-            if session.recv_ready():
-                data = session.recv(self.bufsize)
-                yield (data)
-               
+
+        # Each call waits on its own selector: a shared one is level
+        # triggered for every registered channel, so one that is not
+        # being read (e.g. its consumer is busy) would wake all the
+        # other pollers over and over. DefaultSelector is epoll on
+        # Linux, kqueue on BSD/macOS and select() elsewhere.
+        selector = selectors.DefaultSelector()
+
+        # Bind the methods used on every iteration to locals to keep
+        # attribute lookups out of the loop.
+        monotonic = time.monotonic
+        wait = selector.select
+        recv = session.recv
+        recv_ready = session.recv_ready
+        exit_status_ready = session.exit_status_ready
+        bufsize = self.bufsize
+
+        selector.register(session, selectors.EVENT_READ)
+        try:
+            while True:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    if not exit_status_ready():
+                        timeout_flag = True
+                        break
+                    remaining = 0
+
+                # Sleep in the kernel until the channel is readable instead
+                # of spinning on recv_ready(). recv_ready() is checked
+                # after every wakeup: with libssh2 the data can already
+                # be buffered by a read on another channel.
+                wait(timeout=min(interval, remaining))
+
+                # Drain everything that is buffered before waiting again
+                # so that bursts of output take a single wakeup.
+                # paramiko has no recv_into(): recv() already hands over
+                # a new bytes object cut from its internal buffer, so it
+                # is yielded as is rather than copied into a reusable
+                # buffer, which would only add a copy.
+                # The deadline is checked per chunk as well, otherwise a
+                # command that never stops writing would never time out.
+                drained = False
+                while recv_ready():
+                    if deadline - monotonic() <= 0 and not exit_status_ready():
+                        break
+                    data = recv(bufsize)
+                    if not data:
+                        break
+                    drained = True
+                    if prompts:
+                        tail = (tail + data)[-_PROMPT_TAIL:]
+                        if _PROMPT_RE.search(tail):
+                            # sendall() fails on a non-blocking channel
+                            # once the remote window is full.
+                            session.setblocking(1)
+                            try:
+                                self._run_send_input(session,
+                                                     prompts.popleft())
+                            finally:
+                                session.setblocking(0)
+                            tail = b''
+                    yield (data)
+                if drained:
+                    interval = min_interval
+                elif exit_status_ready() and not recv_ready():
+                    break
+                else:
+                    interval = min(interval * 1.5, max_interval)
+        finally:
+            selector.unregister(session)
+            selector.close()
+ 
+        # Closing the channel also releases its fd, so only do it once
+        # the session is no longer registered with the selector.
+        if timeout_flag:
+            self.info('timed out after %d seconds', maxseconds)
+            session.close()
+            raise TimeoutError('command exceeded %ss' % (maxseconds))
+ 
+ 
+# ================================================================
+# class AsyncCommand
+# ================================================================
+class AsyncCommand:
+    '''
+    The asyncio counterpart of Command, returned by
+    AsyncMySSH.run_async():
+ 
+        cmd = ssh.run_async('uname -a')
+        async for data in cmd:
+            sys.stdout.write(data.decode())
+        print 'status = %d' % (await cmd.exit_status())
+    '''
+    def __init__(self, poll):
+        '''
+        @param poll  Called with the function that sets the exit status,
+                     returns the async generator that runs the command.
+        '''
+        self.status = None
+        self._output = poll(self._set_status)
+ 
+    def _set_status(self, status):
+        self.status = status
+ 
+    def __aiter__(self):
+        return self
+ 
+    async def __anext__(self):
+        return await self._output.__anext__()
+ 
+    async def output(self):
+        '''
+        Read the rest of the output.
+ 
+        @returns the output decoded as UTF-8.
+        '''
+        buf = bytearray()
+        async for data in self:
+            buf.extend(data)
+        return buf.decode('utf-8', 'replace')
+ 
+    async def exit_status(self):
+        '''
+        Wait for the command to complete, output that was not read
+        yet is discarded.
+ 
+        @returns the exit status of the command.
+        '''
+        async for _ in self:
+            pass
+        return self.status
+ 
+ 
+# ================================================================
+# class AsyncMySSH
+# ================================================================
+class AsyncMySSH:
+    '''
+    Create an SSH connection to a server and execute commands from
+    asyncio. It is backed by asyncssh so that one event loop can drive
+    many connections instead of blocking a thread per command.
+    Here is a typical usage:
+ 
+        async def uname(hostname):
+            ssh = AsyncMySSH()
+            if await ssh.connect(hostname, 'user', 'password') is False:
+                return None
+            cmd = ssh.run_async('uname -a')
+            output = await cmd.output()
+            status = await cmd.exit_status()
+            ssh.close()
+            return status, output
+ 
+        outputs = await asyncio.gather(*[uname(h) for h in hostnames])
+    '''
+    def __init__(self, compress=False):
+        '''
+        @param compress  Enable/disable compression (default=False).
+        '''
+        if asyncssh is None:
+            raise ImportError('AsyncMySSH requires asyncssh')
+        self.conn = None
+        self.compress = compress
+        self.bufsize = 65536
+        self.logger = _logger
+        self.info = self.logger.info
+ 
+    async def connect(self, hostname, username, password, port=22):
+        '''
+        Connect to the host.
+ 
+        @param hostname  The hostname.
+        @param username  The username.
+        @param password  The password.
+        @param port      The port (default=22).
+ 
+        @returns True if the connection succeeded or false otherwise.
+        '''
+        self.info('connecting %s@%s:%d', username, hostname, port)
+        # asyncssh lists 'none' first in its defaults, so zlib is only
+        # negotiated when it is asked for explicitly.
+        if self.compress:
+            compression_algs = ('zlib@openssh.com', 'zlib', 'none')
+        else:
+            compression_algs = 'none'
+        try:
+            self.conn = await asyncssh.connect(
+                hostname,
+                port=port,
+                username=username,
+                password=password,
+                known_hosts=None,
+                compression_algs=compression_algs)
+            self.info('succeeded: %s@%s:%d', username, hostname, port)
+        except (OSError, asyncssh.Error) as e:
+            self.conn = None
+            self.info('failed: %s@%s:%d: %s', username, hostname, port, e)
+ 
+        return self.conn is not None
+ 
+    def close(self):
+        '''
+        Close the connection.
+        '''
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+ 
+    def run_async(self, cmd, input_data=None, timeout=10, pty=None):
+        '''
+        Run a command with optional input data.
+        The pseudo terminal and the input data are handled as in
+        MySSH.run().
+ 
+        @param cmd         The command to run.
+        @param input_data  The input data (default is None).
+        @param timeout     The timeout in seconds (default is 10 seconds).
+        @param pty         Allocate a pseudo terminal (default is None,
+                           only when there is input data).
+        @returns The AsyncCommand that streams the output (stdout and
+                 stderr combined) and reports the exit status. Iterating
+                 it raises TimeoutError if the command does not complete
+                 in time.
+        @raises ConnectionError if there is no connection.
+        '''
+        self.info('running command: (%d) %s', timeout, cmd)
+        if self.conn is None:
+            self.info('no connection')
+            raise ConnectionError('connection not established')
+ 
+        input_data = MySSH._run_fix_input_data(input_data)
+        if pty is None:
+            pty = len(input_data) > 0
+        return AsyncCommand(functools.partial(self._run_poll_async, cmd,
+                                              input_data, timeout, pty))
+ 
+    async def _run_poll_async(self, cmd, input_data, timeout, pty,
+                              set_status):
+        '''
+        Read the output until the command completes.
+ 
+        @param cmd         The command to run.
+        @param input_data  The input data from _run_fix_input_data().
+        @param timeout     The timeout in seconds.
+        @param pty         True to allocate a pseudo terminal.
+        @param set_status  Called with the exit status.
+        @returns an async generator of output chunks (bytes).
+        @raises TimeoutError if the command does not complete in time.
+        '''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        tail = b''
+        prompts = collections.deque(input_data.splitlines(True) if pty else ())
+        async with self.conn.create_process(
+                cmd,
+                input=None if pty else input_data or None,
+                stderr=asyncssh.STDOUT,
+                encoding=None,
+                term_type='vt100' if pty else None) as proc:
+            try:
+                while True:
+                    data = await asyncio.wait_for(
+                        proc.stdout.read(self.bufsize),
+                        deadline - loop.time())
+                    if not data:
+                        break
+                    if prompts:
+                        tail = (tail + data)[-_PROMPT_TAIL:]
+                        if _PROMPT_RE.search(tail):
+                            proc.stdin.write(prompts.popleft())
+                            tail = b''
+                    yield (data)
+                await asyncio.wait_for(proc.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                self.info('timed out after %d seconds', timeout)
+                raise TimeoutError('command exceeded %ss' % (timeout))
+            set_status(proc.exit_status)
+            self.info('status %s', proc.exit_status)
  
  
 # ================================================================
@@ -256,24 +1081,25 @@ if __name__ == '__main__':
  
     def run_cmd(cmd, indata=None):
         '''
-        Run a command with optional input.
+        Run a command with optional input and stream its output
+        (stdout and stderr combined) to stdout.
  
         @param cmd    The command to execute.
         @param indata The input data.
-        @returns The command exit status and output.
-                 Stdout and stderr are combined.
+        @returns The command exit status.
         '''
-        #print
-        #print '=' * 64
-        print( 'command: %s' % (cmd))
+        print('command: %s' % (cmd))
+        sys.stdout.flush()
         output = ssh.run(cmd, indata, 100)
-        for i in range(10):
-            print (i)
-            print (next(output))
-        print ('status : %d' % (ssh.get_exit_status()))
-        print ('output : %d bytes' % (len(output)))
-        print ('%s' % (output))
+        total = 0
+        for chunk in output:
+            sys.stdout.buffer.write(chunk)
+            total += len(chunk)
+        sys.stdout.buffer.flush()
+        status = output.exit_status()
+        print('status : %d' % (status))
+        print('output : %d bytes' % (total))
+        return status
 
 
     run_cmd('fio --minimal --eta=0 --status-interval=1 /root/random_read_22.fio')
-
@@ -0,0 +1,390 @@
+import asyncio
+import select
+import socket
+import threading
+import time
+
+import pytest
+
+import ssh_poll
+
+
+class FakeChannel:
+    '''
+    The part of paramiko.Channel that MySSH._run_poll uses, backed by
+    a socketpair: whatever is written to peer is the command output.
+    '''
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.blocking = True
+        self.closed = False
+        self.exited = False
+        self.sent = []
+        self.eof_sent = False
+        self.recv_ready_calls = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, blocking):
+        self.blocking = bool(blocking)
+
+    def recv_ready(self):
+        self.recv_ready_calls += 1
+        if not select.select([self.sock], [], [], 0)[0]:
+            return False
+        try:
+            return len(self.sock.recv(1, socket.MSG_PEEK)) > 0
+        except BlockingIOError:
+            return False
+
+    def recv(self, nbytes):
+        return self.sock.recv(nbytes)
+
+    def exit_status_ready(self):
+        return self.exited
+
+    def sendall(self, data):
+        assert self.blocking, 'sendall() on a non-blocking channel'
+        self.sent.append(data)
+
+    def shutdown_write(self):
+        self.eof_sent = True
+
+    def close(self):
+        self.closed = True
+
+
+def poll(channel, timeout=5, input_data=b'', pty=False):
+    ssh = ssh_poll.MySSH()
+    return ssh._run_poll(channel, timeout, input_data, 0.001, 0.05, pty)
+
+
+def test_poll_reads_output_until_exit():
+    channel = FakeChannel()
+    channel.peer.sendall(b'hello\n')
+    channel.exited = True
+    assert b''.join(poll(channel)) == b'hello\n'
+
+
+def test_paused_poller_does_not_wake_others():
+    busy = FakeChannel()
+    busy.peer.sendall(b'x' * 10)
+    paused = poll(busy)
+    next(paused)
+    busy.peer.sendall(b'more output that nobody reads')
+
+    idle = FakeChannel()
+    timer = threading.Timer(0.3, setattr, (idle, 'exited', True))
+    timer.start()
+    assert list(poll(idle)) == []
+    timer.join()
+    paused.close()
+    assert idle.recv_ready_calls < 100
+
+
+class FakeTransport:
+    def __init__(self, active=True):
+        self.active = active
+
+    def is_active(self):
+        return self.active
+
+
+class FakeClient:
+    def __init__(self, active=True):
+        self.transport = FakeTransport(active)
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_key_depends_on_password_and_options():
+    key = ssh_poll.SSHPool.make_key('host', 'user', 'pw', 22, 'paramiko')
+    assert key == ssh_poll.SSHPool.make_key('host', 'user', 'pw', 22,
+                                            'paramiko')
+    assert key != ssh_poll.SSHPool.make_key('host', 'user', 'wrong', 22,
+                                            'paramiko')
+    assert key != ssh_poll.SSHPool.make_key('host', 'user', 'pw', 22,
+                                            'paramiko', compress=True)
+    assert key != ssh_poll.SSHPool.make_key('host', 'user', 'pw', 22,
+                                            'paramiko',
+                                            ciphers=ssh_poll.FAST_CIPHERS)
+    assert 'pw' not in repr(key)
+
+
+def test_pool_hands_out_live_clients_only():
+    key = ssh_poll.SSHPool.make_key('live', 'user', 'pw', 22, 'paramiko')
+    live = FakeClient()
+    dead = FakeClient(active=False)
+    ssh_poll.SSHPool.release(key, live)
+    ssh_poll.SSHPool.release(key, dead)
+    assert ssh_poll.SSHPool.acquire(key) is live
+    assert dead.closed
+    assert ssh_poll.SSHPool.acquire(key) is None
+
+
+def test_pool_expires_idle_clients(monkeypatch):
+    key = ssh_poll.SSHPool.make_key('idle', 'user', 'pw', 22, 'paramiko')
+    now = [1000.0]
+    monkeypatch.setattr(ssh_poll.time, 'monotonic', lambda: now[0])
+    stale = FakeClient()
+    ssh_poll.SSHPool.release(key, stale)
+    now[0] += ssh_poll.SSHPool.max_idle + 1
+    assert ssh_poll.SSHPool.acquire(key) is None
+    assert stale.closed
+
+    old = FakeClient()
+    ssh_poll.SSHPool.release(key, old)
+    now[0] += ssh_poll.SSHPool.max_idle + 1
+    ssh_poll.SSHPool.release(key, FakeClient())
+    assert old.closed
+
+
+def test_pool_expires_idle_clients_of_other_keys(monkeypatch):
+    gone = ssh_poll.SSHPool.make_key('gone', 'user', 'pw', 22, 'paramiko')
+    other = ssh_poll.SSHPool.make_key('other', 'user', 'pw', 22, 'paramiko')
+    now = [1000.0]
+    monkeypatch.setattr(ssh_poll.time, 'monotonic', lambda: now[0])
+    stale = FakeClient()
+    ssh_poll.SSHPool.release(gone, stale)
+    now[0] += ssh_poll.SSHPool.max_idle + 1
+    ssh_poll.SSHPool.release(other, FakeClient())
+    assert stale.closed
+    assert gone not in ssh_poll.SSHPool._pools
+
+
+def test_pool_close_all():
+    key = ssh_poll.SSHPool.make_key('all', 'user', 'pw', 22, 'paramiko')
+    client = FakeClient()
+    ssh_poll.SSHPool.release(key, client)
+    ssh_poll.SSHPool.close_all()
+    assert client.closed
+    assert ssh_poll.SSHPool._pools == {}
+
+
+def test_run_without_connection_raises():
+    with pytest.raises(ConnectionError):
+        ssh_poll.MySSH().run('uname -a')
+
+
+def test_fix_input_data():
+    fix = ssh_poll.MySSH._run_fix_input_data
+    assert fix(None) == b''
+    assert fix('') == b''
+    assert fix('a') == b'a\n'
+    assert fix('a\\nb') == b'a\nb\n'
+    assert fix('a\nb\n') == b'a\nb\n'
+
+
+def test_input_is_sent_up_front_without_pty():
+    channel = FakeChannel()
+    channel.exited = True
+    list(poll(channel, input_data=b'data\n'))
+    assert channel.sent == [b'data\n']
+    assert channel.eof_sent
+
+
+def test_input_is_not_sent_without_prompt_with_pty():
+    channel = FakeChannel()
+    gen = poll(channel, input_data=b'secret\n', pty=True)
+    channel.peer.sendall(b'starting\n')
+    assert next(gen) == b'starting\n'
+    channel.exited = True
+    list(gen)
+    assert channel.sent == []
+    assert not channel.eof_sent
+
+
+def test_one_input_line_is_sent_per_prompt():
+    channel = FakeChannel()
+    gen = poll(channel, input_data=b'old\nnew\nnew\n', pty=True)
+    channel.peer.sendall(b'starting\n')
+    assert next(gen) == b'starting\n'
+    assert channel.sent == []
+    channel.peer.sendall(b'Current password: ')
+    next(gen)
+    assert channel.sent == [b'old\n']
+    channel.peer.sendall(b'\nNew password: ')
+    next(gen)
+    assert channel.sent == [b'old\n', b'new\n']
+    assert channel.blocking is False
+    channel.exited = True
+    list(gen)
+    assert channel.sent == [b'old\n', b'new\n']
+
+
+def test_prompt_re():
+    assert ssh_poll._PROMPT_RE.search(b'[sudo] password for user: ')
+    assert ssh_poll._PROMPT_RE.search(b'Password:')
+    assert not ssh_poll._PROMPT_RE.search(b'password: ok\n')
+    assert not ssh_poll._PROMPT_RE.search(b'passwords differ\n')
+
+
+def test_poll_times_out():
+    channel = FakeChannel()
+    with pytest.raises(TimeoutError):
+        list(poll(channel, timeout=0.2))
+    assert channel.closed
+
+
+def test_exit_status_drains_output_and_times_out():
+    channel = FakeChannel()
+    channel.peer.sendall(b'unread output')
+    cmd = ssh_poll.Command(channel, poll(channel, timeout=0.2))
+    with pytest.raises(TimeoutError):
+        cmd.exit_status()
+    assert not channel.recv_ready()
+
+
+def test_poll_times_out_while_output_keeps_coming():
+    channel = FakeChannel()
+    stop = threading.Event()
+
+    def produce():
+        while not stop.is_set():
+            try:
+                channel.peer.sendall(b'y\n')
+            except OSError:
+                break
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    start = time.monotonic()
+    try:
+        with pytest.raises(TimeoutError):
+            for _ in poll(channel, timeout=0.3):
+                time.sleep(0.001)
+    finally:
+        stop.set()
+        channel.sock.close()
+        producer.join()
+    assert time.monotonic() - start < 1
+    assert channel.closed
+
+
+def test_libssh2_transport_notices_closed_socket():
+    sock, peer = socket.socketpair()
+    transport = ssh_poll._Libssh2Transport(sock, None)
+    assert transport.is_active()
+    peer.sendall(b'pending')
+    assert transport.is_active()
+    peer.close()
+    sock.recv(16)
+    assert not transport.is_active()
+
+
+class FakeSession:
+    def block_directions(self):
+        return 0
+
+
+def test_libssh2_transport_waits_when_nothing_is_blocked():
+    pytest.importorskip('ssh2.session')
+    sock, peer = socket.socketpair()
+    transport = ssh_poll._Libssh2Transport(sock, FakeSession())
+    eagain = ssh_poll.ssh2.error_codes.LIBSSH2_ERROR_EAGAIN
+    results = iter([eagain, eagain, eagain, 0])
+    start = time.monotonic()
+    assert transport.call(lambda: next(results)) == 0
+    assert time.monotonic() - start >= 0.02
+
+
+class FakeProcess:
+    '''
+    The part of asyncssh.SSHClientProcess that AsyncMySSH uses.
+    '''
+    def __init__(self, chunks, status, delay=0):
+        self.chunks = list(chunks)
+        self.exit_status = status
+        self.delay = delay
+        self.stdout = self
+        self.stdin = self
+        self.written = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def read(self, nbytes):
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def write(self, data):
+        self.written.append(data)
+
+    async def wait(self):
+        await asyncio.sleep(self.delay)
+
+
+class FakeConnection:
+    def __init__(self, process):
+        self.process = process
+
+    def create_process(self, cmd, **kwargs):
+        self.kwargs = kwargs
+        return self.process
+
+
+def async_ssh(process):
+    pytest.importorskip('asyncssh')
+    ssh = ssh_poll.AsyncMySSH()
+    ssh.conn = FakeConnection(process)
+    return ssh
+
+
+def test_async_command_reports_exit_status():
+    ssh = async_ssh(FakeProcess([b'a', b'b'], 3))
+
+    async def run():
+        cmd = ssh.run_async('false')
+        return await cmd.output(), await cmd.exit_status()
+    assert asyncio.run(run()) == ('ab', 3)
+
+
+def test_async_input_waits_for_prompt_with_pty():
+    process = FakeProcess([b'Password: ', b'ok\n'], 0)
+    ssh = async_ssh(process)
+
+    async def run():
+        return await ssh.run_async('sudo true', 'secret').exit_status()
+    assert asyncio.run(run()) == 0
+    assert ssh.conn.kwargs['input'] is None
+    assert process.written == [b'secret\n']
+
+
+def test_async_wait_is_bounded_by_timeout():
+    ssh = async_ssh(FakeProcess([], 0, delay=5))
+
+    async def run():
+        return await ssh.run_async('sleep 5', timeout=0.2).exit_status()
+    with pytest.raises(TimeoutError):
+        asyncio.run(run())
+
+
+def test_async_run_without_connection_raises():
+    pytest.importorskip('asyncssh')
+    with pytest.raises(ConnectionError):
+        ssh_poll.AsyncMySSH().run_async('uname -a')
+
+
+@pytest.mark.parametrize('compress, algs', [
+    (False, 'none'),
+    (True, ('zlib@openssh.com', 'zlib', 'none')),
+])
+def test_async_connect_compression(monkeypatch, compress, algs):
+    asyncssh = pytest.importorskip('asyncssh')
+    calls = []
+
+    async def connect(hostname, **kwargs):
+        calls.append(kwargs)
+        return object()
+    monkeypatch.setattr(asyncssh, 'connect', connect)
+    ssh = ssh_poll.AsyncMySSH(compress=compress)
+    assert asyncio.run(ssh.connect('host', 'user', 'pw'))
+    assert calls[0]['compression_algs'] == algs